@@ -59,16 +59,24 @@ def beam_search(model, inputs, indices, beam_size, device,
 
     encoder_outputs, hidden_state = model.encoder(inputs)
 
+    # the keys of the attention are only computed once
+    # instead of at every step of the decoder
+    attn_keys = model.decoder.attn.compute_keys(
+        encoder_outputs)
+
     # a beam is created for each element of the batch
     beams = create_beams(
         beam_size=beam_size, indices=indices,
         max_len=max_len, device=device,
         batch_size=batch_size)
 
-    # the decoder has beam_size * batch_size inputs
-    decoder_input = torch.tensor(start_index).to(device)
-    decoder_input = decoder_input.expand(
-        batch_size * beam_size, 1)
+    # the decoder has beam_size * batch_size inputs and
+    # only receives the last tokens of the hyps, because
+    # the history of the hyps is stored by the beams
+    decoder_input = torch.full(
+        (batch_size * beam_size, 1), int(start_index),
+        dtype=torch.long, device=device)
+    num_steps = 1
 
     indices = torch.arange(batch_size).to(device)
     indices = indices.unsqueeze(1).repeat(
@@ -78,6 +86,7 @@ def beam_search(model, inputs, indices, beam_size, device,
     # making `encoder_outputs` of size
     # [batch_size * beam_size, seq_len, hidden_size]
     encoder_outputs = encoder_outputs.index_select(0, indices)
+    attn_keys = attn_keys.index_select(0, indices)
     hidden_state = select_hidden_states(hidden_state, indices)
 
     for _ in range(max_len):
@@ -85,11 +94,11 @@ def beam_search(model, inputs, indices, beam_size, device,
             break
 
         logits, hidden_state = model.decoder(
-            inputs=decoder_input[:, -1:],
+            inputs=decoder_input,
             encoder_outputs=encoder_outputs,
+            attn_keys=attn_keys,
             prev_hiddens=hidden_state)
 
-        logits = logits[:, -1:, :]
         scores = log_softmax(logits, dim=-1)
         scores = scores.view(batch_size, beam_size, -1)
 
@@ -107,16 +116,15 @@ def beam_search(model, inputs, indices, beam_size, device,
         ])
 
         hidden_state = select_hidden_states(hidden_state, indices)
-        decoder_input = torch.index_select(decoder_input, 0, indices)
 
-        prev_output = torch.cat([b.token_ids[-1] for b in beams])
-        prev_output = prev_output.unsqueeze(-1)
-        decoder_input = torch.cat([decoder_input, prev_output], dim=-1)
+        decoder_input = torch.cat([b.token_ids[-1] for b in beams])
+        decoder_input = decoder_input.unsqueeze(-1)
+        num_steps += 1
 
     # merging the best result from the beams into
     # a single batch of outputs
     top_scores, top_preds = list(
-        zip(*[b.get_result(decoder_input.size(-1)) for b in beams]))
+        zip(*[b.get_result(num_steps) for b in beams]))
 
     top_preds = torch.cat(top_preds).view(batch_size, -1)
     top_scores = torch.cat(top_scores).view(
@@ -188,7 +196,8 @@ class Beam:
         self.top_scores.append(self.scores)
 
         # selecting the id of the best hyp at the current step
-        self.hyp_ids.append(top_idxs / vocab_size)
+        self.hyp_ids.append(top_idxs.div(
+            vocab_size, rounding_mode='floor'))
         self.token_ids.append(top_idxs % vocab_size)
 
         time_step = len(self.token_ids)
@@ -11,17 +11,31 @@
 
 import torch
 import random
+import math
+
+from typing import Optional
+from contextlib import nullcontext
 
 from torch.nn.modules import (
     Module, ModuleList)
 
 from torch.nn.functional import (
-    log_softmax, softmax, linear,
-    embedding)
+    log_softmax, linear, embedding,
+    scaled_dot_product_attention)
 
 from torch.nn import (
-    Linear, Softmax, Parameter, 
-    GRU, Dropout, Embedding)
+    Linear, Parameter, GRU,
+    Dropout, Embedding)
+
+from torch.nn.utils.rnn import (
+    PackedSequence, pack_padded_sequence,
+    pad_packed_sequence)
+
+try:
+    from numba import njit
+    NUMBA_INSTALLED = True
+except ImportError:
+    NUMBA_INSTALLED = False
 
 
 def setup_model_args(parser):
@@ -38,6 +52,11 @@ def setup_model_args(parser):
         type=int,
         default=128,
         help='Embedding dimension for the tokens.')
+    parser.add_argument(
+        '--autocast',
+        type=bool,
+        default=False,
+        help='Run the model in bfloat16 with autocast.')
 
 
 def create_model(args, tokenizers, device):
@@ -50,27 +69,136 @@ def create_model(args, tokenizers, device):
         target_tokenizer.eos_id(), source_tokenizer.pad_id(), \
         target_tokenizer.pad_id(), source_tokenizer.unk_id()
 
-    tensor_indices = [
-        torch.tensor(i).to(device) for i in special_ids]
-
     model = Seq2Seq(
         source_vocab_size=len(source_tokenizer),
         target_vocab_size=len(target_tokenizer),
-        indices=tensor_indices,
+        indices=special_ids,
         **vars(args)).to(device)
 
     return model
 
 
-def neginf(dtype):
+@torch.jit.script
+def attend(decoder_output, encoder_outputs, attn_keys,
+           combine_weight, attn_mask=None):
+    # type: (Tensor, Tensor, Tensor, Tensor, Optional[Tensor]) -> Tensor
+    """
+    Computes the context vectors with the projected keys and
+    combines them with the decoder output. The scores are
+    not scaled, as the general score of Luong attention is a
+    plain dot product. The function is scripted so the chain
+    of small ops runs without python overhead at every
+    decoding step.
+    """
+    # the mask of sdpa marks the positions that take part
+    # in the attention, which is the opposite of `attn_mask`
+    if attn_mask is not None:
+        attn_mask = attn_mask.logical_not().view(
+            attn_mask.size(0), 1, 1, attn_mask.size(1))
+
+    # the fused kernels of sdpa only accept 4 dimensional
+    # inputs, so a singleton head dimension is added
+    attn_applied = scaled_dot_product_attention(
+        decoder_output.unsqueeze(1), attn_keys.unsqueeze(1),
+        encoder_outputs.unsqueeze(1), attn_mask=attn_mask,
+        scale=1.0).squeeze(1)
+
+    # the combine layer is applied to the two halves of
+    # its input separately, where the second product is
+    # accumulated onto the first by a single `addmm` over
+    # the flattened time steps, so the concatenated input
+    # is never built
+    output_weight, context_weight = \
+        combine_weight.chunk(2, dim=1)
+
+    outputs = linear(decoder_output, output_weight)
+    outputs = torch.addmm(
+        outputs.flatten(0, 1), attn_applied.flatten(0, 1),
+        context_weight.t()).view_as(outputs)
+
+    return outputs
+
+
+def gru_step(layer, inputs, hidden_state):
     """
-    Return a representable finite 
-    number near -inf for a dtype.
+    Runs a single time step through a GRU layer with the
+    weights of the layer. The cell avoids the setup cost of
+    the cudnn kernel, which dominates for sequences of
+    length 1 during step-by-step decoding.
     """
-    if dtype is torch.float16:
-        return -65504
+    inputs = inputs.squeeze(1)
+    hidden_state = hidden_state.squeeze(0)
+
+    # the fused pointwise kernel is used for float32
+    # inference on the cpu if numba is available
+    if NUMBA_INSTALLED and not inputs.is_cuda and \
+            inputs.dtype == torch.float32 and \
+            not torch.is_autocast_cpu_enabled() and \
+            not torch.is_grad_enabled():
+        gates_ih = linear(
+            inputs, layer.weight_ih_l0, layer.bias_ih_l0)
+        gates_hh = linear(
+            hidden_state, layer.weight_hh_l0, layer.bias_hh_l0)
+
+        next_hidden_state = torch.empty_like(hidden_state)
+        gru_pointwise(
+            gates_ih.numpy(), gates_hh.numpy(),
+            hidden_state.numpy(), next_hidden_state.numpy())
+
     else:
-        return -1e20
+        next_hidden_state = torch.gru_cell(
+            inputs, hidden_state,
+            layer.weight_ih_l0, layer.weight_hh_l0,
+            layer.bias_ih_l0, layer.bias_hh_l0)
+
+    return next_hidden_state.unsqueeze(1), \
+        next_hidden_state.unsqueeze(0)
+
+
+if NUMBA_INSTALLED:
+    @njit(fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'},
+          cache=True)
+    def gru_pointwise(gates_ih, gates_hh, hidden_state,
+                      outputs):
+        """
+        Computes the gates and the new hidden state of a
+        GRU cell from the input and hidden projections in
+        a single pass over the memory. The gates are laid
+        out in the reset, update, new order of pytorch.
+        """
+        batch_size, hidden_size = hidden_state.shape
+
+        for btc_idx in range(batch_size):
+            for idx in range(hidden_size):
+                upd_idx = idx + hidden_size
+                new_idx = idx + 2 * hidden_size
+
+                # the sigmoid is computed with tanh, which
+                # can not overflow for saturated gates
+                reset = 0.5 + 0.5 * math.tanh(0.5 * (
+                    gates_ih[btc_idx, idx] +
+                    gates_hh[btc_idx, idx]))
+                update = 0.5 + 0.5 * math.tanh(0.5 * (
+                    gates_ih[btc_idx, upd_idx] +
+                    gates_hh[btc_idx, upd_idx]))
+                new = math.tanh(
+                    gates_ih[btc_idx, new_idx] +
+                    reset * gates_hh[btc_idx, new_idx])
+
+                outputs[btc_idx, idx] = \
+                    (1.0 - update) * new + \
+                    update * hidden_state[btc_idx, idx]
+
+
+def apply_packed(module, inputs):
+    """
+    Applies a module to the inputs, which might be
+    a packed sequence.
+    """
+    if isinstance(inputs, PackedSequence):
+        return inputs._replace(data=module(inputs.data))
+
+    return module(inputs)
 
 
 # NOTE currently unused function
@@ -105,11 +233,24 @@ class Seq2Seq(Module):
     """
 
     def __init__(self, embedding_size, hidden_size, indices,
-                 source_vocab_size, target_vocab_size, **kwargs):
+                 source_vocab_size, target_vocab_size,
+                 autocast=False, **kwargs):
         super().__init__()
 
+        self.autocast = autocast
+
+        # the special indices are stored as python ints, so
+        # they are used as scalars in comparisons and fills
         self.start_idx, self.end_idx, \
-            self.pad_idx, _, self.unk_idx = indices
+            self.pad_idx, _, self.unk_idx = \
+            [int(idx) for idx in indices]
+
+        # column of start tokens, which is expanded to the
+        # size of the batch for teacher forcing
+        self.register_buffer(
+            '_start_col',
+            torch.full((1, 1), self.start_idx, dtype=torch.long),
+            persistent=False)
 
         self.encoder = Encoder(
             input_size=embedding_size,
@@ -122,51 +263,507 @@ class Seq2Seq(Module):
             hidden_size=hidden_size,
             vocab_size=target_vocab_size)
 
+        # captured decoder steps for inference on the gpu
+        # keyed by the shape of the encoder outputs and the
+        # number of times each shape has been decoded
+        self._graphs = {}
+        self._graph_counts = {}
+
+    def train(self, mode=True):
+        """
+        Sets the training mode and drops the captured
+        decoder graphs when switching to training.
+        """
+        if mode:
+            self._graphs.clear()
+            self._graph_counts.clear()
+
+        return super().train(mode)
+
     def forward(self, inputs, attn_mask=None, targets=None, 
-                max_len=50):
+                max_len=50, return_scores=True, beam_size=None):
         """
         Runs the inputs through the encoder-decoder model.
+        Beam search is used for decoding if `beam_size` is
+        provided and there are no targets.
         """
         # inputs are expexted in sequence-first format
-        batch_size = inputs.size(0)
         max_len = targets.size(1) if targets is not None \
             else max_len
 
         if attn_mask is None:
             attn_mask = inputs.eq(self.pad_idx)
 
-        # the number of layers in the decoder must be equal
-        # to the number of layers in the encoder because of
-        # the initial hidden states from the encoder
-        encoder_outputs, hidden_states = self.encoder(inputs)
+        # the lengths are used by the encoder to skip the
+        # padded positions of the inputs, empty inputs are
+        # given a length of 1 as packing rejects zero lengths
+        lengths = attn_mask.logical_not().sum(dim=-1)
+
+        # the first position of an empty input is left out
+        # of the mask as well, because attention over a fully
+        # masked row would produce nan values
+        empty = lengths.eq(0)
+        if empty.any():
+            attn_mask = attn_mask.clone()
+            attn_mask[:, 0] &= empty.logical_not()
+            lengths = lengths.clamp(min=1)
+
+        # the encoder-decoder runs in bfloat16 with autocast
+        # if it is requested, while the log softmax of the
+        # decoder is explicitly computed in float32, otherwise
+        # an autocast region of the caller is left unchanged
+        if self.autocast:
+            autocast = torch.autocast(
+                device_type=inputs.device.type,
+                dtype=torch.bfloat16)
+        else:
+            autocast = nullcontext()
+
+        with autocast:
+            # the number of layers in the decoder must be
+            # equal to the number of layers in the encoder
+            # because of the initial hidden states
+            encoder_outputs, hidden_states = \
+                self.encoder(inputs, lengths)
+
+            # the keys of the attention are computed once
+            # and used at every decoding step
+            attn_keys = self.decoder.attn.compute_keys(
+                encoder_outputs)
+
+            if beam_size is not None and targets is None:
+                return self.decode_beam(
+                    encoder_outputs=encoder_outputs,
+                    attn_keys=attn_keys,
+                    hidden_states=hidden_states,
+                    attn_mask=attn_mask,
+                    beam_size=beam_size,
+                    max_len=max_len)
+
+            # if targets are provided and training then
+            # apply teacher forcing 50% of the time, which
+            # is decided for the whole batch so the target
+            # sequence is processed by the decoder at once
+            if targets is not None and self.training and \
+                    random.random() > 0.5:
+                return self.decode_forced(
+                    targets=targets,
+                    encoder_outputs=encoder_outputs,
+                    attn_keys=attn_keys,
+                    hidden_states=hidden_states,
+                    attn_mask=attn_mask)
+
+            return self.decode_greedy(
+                encoder_outputs=encoder_outputs,
+                attn_keys=attn_keys,
+                hidden_states=hidden_states,
+                attn_mask=attn_mask,
+                max_len=max_len,
+                stop_early=targets is None,
+                return_scores=return_scores)
+
+    def decode_forced(self, targets, encoder_outputs,
+                      attn_keys, hidden_states,
+                      attn_mask=None):
+        """
+        Decodes the targets with teacher forcing by running
+        the whole shifted target sequence through the
+        decoder at once.
+        """
+        batch_size = targets.size(0)
+        start = self._start_col.expand(batch_size, 1)
 
-        scores = []
-        preds = self.start_idx.detach().expand(batch_size, 1)
+        # the decoder receives the targets shifted right
+        # by one step with the start token in front
+        decoder_inputs = torch.cat(
+            [start, targets[:, :-1]], dim=-1)
 
+        scores, _ = self.decoder(
+            inputs=decoder_inputs,
+            encoder_outputs=encoder_outputs,
+            attn_keys=attn_keys,
+            prev_hiddens=hidden_states,
+            attn_mask=attn_mask)
+
+        _, preds = scores.max(dim=-1)
+
+        return scores, preds
+
+    def decode_greedy(self, encoder_outputs, attn_keys,
+                      hidden_states, attn_mask=None, max_len=50,
+                      stop_early=False, check_every=8,
+                      return_scores=True):
+        """
+        Decodes the encoded inputs step-by-step by always
+        feeding the most probable token to the next step.
+        The predictions and scores are written into buffers
+        that are allocated once for the whole decoding and
+        the returned tensors are views of these buffers.
+        If `return_scores` is not set, the log softmax is
+        skipped and the scores are returned as `None`.
+        """
+        batch_size = encoder_outputs.size(0)
+
+        preds = encoder_outputs.new_full(
+            (batch_size, max_len + 1), self.pad_idx,
+            dtype=torch.long)
+        preds[:, 0] = self.start_idx
+
+        # the score buffer is created at the first step
+        # so it gets the same dtype as the decoder output
+        scores = None
+
+        # tracking the finished sequences on the device
+        # and only checking on the host after every
+        # `check_every` steps to see if decoding is done
+        finished = preds.new_zeros(
+            (batch_size, ), dtype=torch.bool)
+
+        # the result of the check is copied to pinned memory
+        # without blocking and only read at the next check,
+        # so the copy overlaps with the following steps
+        done = torch.zeros(
+            (1, ), dtype=torch.bool,
+            pin_memory=finished.is_cuda)
+        done_event, done_len = None, max_len
+
+        # the inputs of the decoder are the predictions of
+        # the previous step instead of views of `preds`,
+        # because the embedding saves its inputs for the
+        # backward pass, which would be invalidated by the
+        # in-place writes into the buffer
+        step_inputs = self._start_col.expand(batch_size, 1)
+
+        # during inference on the gpu the decoder step is
+        # replayed from a captured cuda graph if the shape
+        # of the inputs is frequent enough
+        graph = None
+        if encoder_outputs.is_cuda and not self.training and \
+                not torch.is_grad_enabled():
+            graph = self.get_graph(
+                inputs=step_inputs,
+                encoder_outputs=encoder_outputs,
+                attn_keys=attn_keys,
+                hidden_states=hidden_states,
+                attn_mask=attn_mask,
+                normalize=return_scores)
+
+        # NOTE the steps can not be unrolled into chunks,
+        # because the input of each step is the prediction
+        # of the previous one, which depends on the attention
+        # so the projection of the attention is moved to the
+        # keys instead (see `Attention.compute_keys`)
         for idx in range(max_len):
-            # if targets are provided and training then apply
-            # teacher forcing 50% of the time
-            if targets is not None and self.training and \
-                    random.random() > 0.5:
-                prev_output = targets[:, idx].unsqueeze(1)
+            if graph is not None:
+                step_scores = graph.step(step_inputs)
+
             else:
-                prev_output = preds[:, -1:]
+                step_scores, hidden_states = self.decoder(
+                    inputs=step_inputs,
+                    encoder_outputs=encoder_outputs,
+                    attn_keys=attn_keys,
+                    prev_hiddens=hidden_states,
+                    attn_mask=attn_mask,
+                    normalize=return_scores)
+
+            # the argmax of the logits is the same as the
+            # argmax of the log softmax
+            step_preds = step_scores.argmax(dim=-1)
+            preds[:, idx + 1] = step_preds.squeeze(1)
+            step_inputs = step_preds
+
+            if return_scores:
+                if scores is None:
+                    scores = step_scores.new_empty((
+                        batch_size, max_len,
+                        step_scores.size(-1)))
+
+                scores[:, idx] = step_scores.squeeze(1)
+
+            if not stop_early:
+                continue
+
+            finished |= step_preds.squeeze(1).eq(self.end_idx)
+
+            if (idx + 1) % check_every != 0:
+                continue
+
+            if done_event is not None:
+                done_event.synchronize()
+                if done.item():
+                    max_len = done_len
+                    break
+
+            done.copy_(finished.all(), non_blocking=True)
+            done_len = idx + 1
+
+            if done.is_pinned():
+                done_event = torch.cuda.Event()
+                done_event.record()
+
+            elif done.item():
+                max_len = done_len
+                break
+
+        # views are returned without copying the buffers,
+        # consumers can make them contiguous if needed
+        if scores is not None:
+            scores = scores[:, :max_len]
 
-            step_scores, hidden_states = self.decoder(
-                inputs=prev_output,
+        preds = preds[:, 1:max_len + 1]
+
+        return scores, preds
+
+    def decode_beam(self, encoder_outputs, attn_keys,
+                    hidden_states, attn_mask=None, beam_size=10,
+                    max_len=50, check_every=8):
+        """
+        Decodes the encoded inputs with beam search. The hyps
+        of every input are flattened into a single batch of
+        size `batch_size * beam_size`, so each step is one
+        call of the decoder for the whole batch. Returns the
+        length normalized scores and the tokens of the best
+        hyp for each input.
+        """
+        batch_size = encoder_outputs.size(0)
+        flat_size = batch_size * beam_size
+        vocab_size = self.decoder.out_bias.size(0)
+
+        # each input is repeated for the hyps of its beam
+        encoder_outputs = encoder_outputs.repeat_interleave(
+            beam_size, dim=0)
+        attn_keys = attn_keys.repeat_interleave(
+            beam_size, dim=0)
+        hidden_states = [
+            hs.repeat_interleave(beam_size, dim=1)
+            for hs in hidden_states]
+
+        if attn_mask is not None:
+            attn_mask = attn_mask.repeat_interleave(
+                beam_size, dim=0)
+
+        preds = encoder_outputs.new_full(
+            (batch_size, beam_size, max_len + 1),
+            self.pad_idx, dtype=torch.long)
+        preds[:, :, 0] = self.start_idx
+
+        # only the first hyp of each beam is alive at the
+        # start, otherwise the same tokens would be selected
+        # by each of the identical hyps
+        beam_scores = encoder_outputs.new_full(
+            (batch_size, beam_size), float('-inf'),
+            dtype=torch.float)
+        beam_scores[:, 0] = 0
+
+        finished = preds.new_zeros(
+            (batch_size, beam_size), dtype=torch.bool)
+        lengths = preds.new_zeros((batch_size, beam_size))
+
+        # finished hyps can only be continued with padding,
+        # which leaves their scores unchanged
+        finished_scores = beam_scores.new_full(
+            (vocab_size, ), float('-inf'))
+        finished_scores[self.pad_idx] = 0
+
+        offsets = torch.arange(
+            batch_size, device=preds.device).unsqueeze(1)
+        offsets = offsets * beam_size
+
+        for idx in range(max_len):
+            log_probs, hidden_states = self.decoder(
+                inputs=preds[:, :, idx].reshape(flat_size, 1),
                 encoder_outputs=encoder_outputs,
+                attn_keys=attn_keys,
                 prev_hiddens=hidden_states,
                 attn_mask=attn_mask)
 
-            _, step_preds = step_scores.max(dim=-1)
+            log_probs = log_probs.float().view(
+                batch_size, beam_size, vocab_size)
+            log_probs = torch.where(
+                finished.unsqueeze(-1), finished_scores,
+                log_probs)
+
+            # selecting the best `beam_size` candidates of
+            # each input from all extensions of its hyps
+            scores = beam_scores.unsqueeze(-1) + log_probs
+            beam_scores, top_idxs = scores.view(
+                batch_size, -1).topk(beam_size, dim=-1)
+
+            hyp_ids = top_idxs.div(
+                vocab_size, rounding_mode='floor')
+            token_ids = top_idxs % vocab_size
+
+            # reordering the states by the selected hyps
+            hyp_indices = (offsets + hyp_ids).view(-1)
+            hidden_states = [
+                hs.index_select(1, hyp_indices)
+                for hs in hidden_states]
+
+            preds = preds.view(flat_size, -1).index_select(
+                0, hyp_indices).view(batch_size, beam_size, -1)
+            preds[:, :, idx + 1] = token_ids
+
+            finished = finished.gather(1, hyp_ids)
+            lengths = lengths.gather(1, hyp_ids) + \
+                finished.logical_not().long()
+            finished = finished | token_ids.eq(self.end_idx)
+
+            if (idx + 1) % check_every == 0 and \
+                    finished.all().item():
+                max_len = idx + 1
+                break
+
+        # the best hyp is selected by its length
+        # normalized score
+        norm_scores = beam_scores / lengths.float()
+        best_scores, best_ids = norm_scores.max(dim=-1)
+
+        best_ids = best_ids.view(batch_size, 1, 1).expand(
+            batch_size, 1, preds.size(-1))
+        best_preds = preds.gather(1, best_ids).squeeze(1)
+
+        return best_scores, best_preds[:, 1:max_len + 1]
+
+    def get_graph(self, inputs, encoder_outputs,
+                  attn_keys, hidden_states,
+                  attn_mask=None, normalize=True,
+                  max_graphs=8, min_count=3,
+                  max_counts=1024):
+        """
+        Returns the captured decoder step for the shape of
+        the encoder outputs loaded with the given states.
+        A graph is only captured after its shape has been
+        decoded `min_count` times, because the source
+        lengths of the batches vary and capturing a graph
+        for a shape that is rarely seen is slower than
+        running the decoder eagerly. Returns `None` if
+        there is no graph for the shape.
+        """
+        key = tuple(encoder_outputs.size()) + (
+            encoder_outputs.dtype, attn_mask is None,
+            normalize)
+
+        graph = self._graphs.get(key)
 
-            preds = torch.cat([preds, step_preds], dim=-1)
-            scores.append(step_scores)
+        if graph is None:
+            # the counts are reset when there are too many
+            # distinct shapes to keep the dict bounded
+            if len(self._graph_counts) == max_counts:
+                self._graph_counts.clear()
 
-        scores = torch.cat(scores, dim=1)
-        preds = preds.narrow(1, 1, preds.size(1) - 1)
+            count = self._graph_counts.get(key, 0) + 1
+            self._graph_counts[key] = count
 
-        return scores, preds
+            if count < min_count:
+                return None
+
+            # dropping the oldest graph when the cache is
+            # full to free its static buffers
+            if len(self._graphs) == max_graphs:
+                del self._graphs[next(iter(self._graphs))]
+
+            graph = DecoderGraph(
+                decoder=self.decoder,
+                inputs=inputs,
+                encoder_outputs=encoder_outputs,
+                attn_keys=attn_keys,
+                hidden_states=hidden_states,
+                attn_mask=attn_mask,
+                normalize=normalize)
+
+            self._graphs[key] = graph
+
+        else:
+            graph.load(
+                encoder_outputs=encoder_outputs,
+                attn_keys=attn_keys,
+                hidden_states=hidden_states,
+                attn_mask=attn_mask)
+
+        return graph
+
+
+class DecoderGraph:
+    """
+    A single decoder step captured as a cuda graph, which
+    is replayed with static input and output buffers.
+    """
+
+    def __init__(self, decoder, inputs, encoder_outputs,
+                 attn_keys, hidden_states,
+                 attn_mask=None, normalize=True,
+                 warmup_steps=3):
+        self.inputs = inputs.clone()
+        self.encoder_outputs = encoder_outputs.clone()
+        self.attn_keys = attn_keys.clone()
+        self.hidden_states = [hs.clone() for hs in hidden_states]
+        self.attn_mask = None if attn_mask is None \
+            else attn_mask.clone()
+
+        def decoder_step():
+            return decoder(
+                inputs=self.inputs,
+                encoder_outputs=self.encoder_outputs,
+                attn_keys=self.attn_keys,
+                prev_hiddens=self.hidden_states,
+                attn_mask=self.attn_mask,
+                normalize=normalize)
+
+        # the weight cast cache of autocast is disabled, so
+        # the casts are recorded in the graph instead of
+        # reading cached tensors, which are freed later
+        autocast = torch.autocast(
+            device_type='cuda',
+            dtype=torch.get_autocast_gpu_dtype(),
+            enabled=torch.is_autocast_enabled(),
+            cache_enabled=False)
+
+        with autocast:
+            # the step has to be run a few times on a side
+            # stream before the capture
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(warmup_steps):
+                    decoder_step()
+            torch.cuda.current_stream().wait_stream(stream)
+
+            self.graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self.graph):
+                self.scores, self.next_hidden_states = \
+                    decoder_step()
+
+    def load(self, encoder_outputs, attn_keys,
+             hidden_states, attn_mask=None):
+        """
+        Copies the states of a new batch into the static
+        input buffers.
+        """
+        self.encoder_outputs.copy_(encoder_outputs)
+        self.attn_keys.copy_(attn_keys)
+
+        for static, hidden_state in zip(
+                self.hidden_states, hidden_states):
+            static.copy_(hidden_state)
+
+        if attn_mask is not None:
+            self.attn_mask.copy_(attn_mask)
+
+    def step(self, inputs):
+        """
+        Replays the captured step for the given inputs. The
+        returned scores are overwritten by the next step.
+        """
+        self.inputs.copy_(inputs)
+        self.graph.replay()
+
+        # the new hidden states become the inputs of the
+        # next replayed step
+        for static, hidden_state in zip(
+                self.hidden_states, self.next_hidden_states):
+            static.copy_(hidden_state)
+
+        return self.scores
 
 
 class Encoder(Module):
@@ -205,25 +802,38 @@ class Encoder(Module):
             for _ in range(2)
         ])
 
-    def forward(self, inputs):
+    def forward(self, inputs, lengths=None):
         """
         Computes the embeddings and runs them through an RNN.
+        If the lengths are provided the inputs are packed, so
+        the RNN layers do not process the padding.
         """
         embedded = self.embedding(inputs)
         embedded = self.dropout(embedded)
 
+        if lengths is not None:
+            embedded = pack_padded_sequence(
+                embedded, lengths.cpu(), batch_first=True,
+                enforce_sorted=False)
+
         outputs, hidden_state = self.rnn[0](embedded)
 
         # merging the two directions of bidirectional layer
-        # by summing along the first axis
-        hidden_states = [hidden_state.sum(0, keepdim=True)]
-        outputs = self.merge(outputs)
+        # by adding the forward and backward states, which
+        # is a single elementwise kernel instead of a reduce
+        hidden_states = [hidden_state[:1] + hidden_state[1:]]
+        outputs = apply_packed(self.merge, outputs)
 
         for layer in self.rnn[1:]:
             outputs, hidden_state = layer(outputs)
-            outputs = self.dropout(outputs)
+            outputs = apply_packed(self.dropout, outputs)
             hidden_states.append(hidden_state)
 
+        if lengths is not None:
+            outputs, _ = pad_packed_sequence(
+                outputs, batch_first=True,
+                total_length=inputs.size(1))
+
         return outputs, hidden_states
 
 
@@ -251,40 +861,63 @@ class Decoder(Module):
             for _ in range(2)
         ])
 
-        self.attn = Attention(hidden_size=hidden_size)
+        # the attention outputs vectors of the embedding size
+        # so the output layer can share the embedding weights
+        # even if the hidden size is different
+        self.attn = Attention(
+            hidden_size=hidden_size,
+            output_size=input_size)
 
         self.out_bias = Parameter(torch.zeros((vocab_size, )))
         self.out_weight = self.embedding.weight
 
     def forward(self, inputs, encoder_outputs, prev_hiddens,
-                attn_mask=None, embed_mask=None):
+                attn_keys=None, attn_mask=None,
+                embed_mask=None, normalize=True):
         """
         Applies decoding with attention mechanism, mixture
         of sofmaxes and multi dropout during training.
         MoS implementation is taken from 
+        If `normalize` is not set, the logits are returned
+        instead of the log probabilities.
         """
+        if attn_keys is None:
+            attn_keys = self.attn.compute_keys(encoder_outputs)
+
         embedded = self.embedding(inputs)
         output = self.dropout(embedded)
 
+        # single steps are computed with the gru cell
+        # function, which shares the weights of the layers
+        step_by_step = inputs.size(1) == 1
+
         hidden_states = []
         for idx, layer in enumerate(self.rnn):
-            output, hidden_state = layer(
-                output, prev_hiddens[idx])
+            if step_by_step:
+                output, hidden_state = gru_step(
+                    layer, output, prev_hiddens[idx])
+            else:
+                output, hidden_state = layer(
+                    output, prev_hiddens[idx])
             output = self.dropout(output)
             hidden_states.append(hidden_state)
 
-        # NOTE attention weights are not used currently
-        # (they could be exported for visualization)
-        output, _ = self.attn(
+        output = self.attn(
             decoder_output=output,
-            hidden_state=hidden_state,
             encoder_outputs=encoder_outputs,
+            attn_keys=attn_keys,
             attn_mask=attn_mask)
 
         logits = linear(
             output, self.out_weight, self.out_bias)
 
-        log_probs = log_softmax(logits, dim=-1)
+        if not normalize:
+            return logits, hidden_states
+
+        # the log probabilities are always float32, as
+        # autocast on the cpu would leave them in bfloat16
+        log_probs = log_softmax(
+            logits, dim=-1, dtype=torch.float32)
 
         return log_probs, hidden_states
 
@@ -295,7 +928,7 @@ class Attention(Module):
     https://arxiv.org/pdf/1508.04025.pdf.
     """
 
-    def __init__(self, hidden_size):
+    def __init__(self, hidden_size, output_size):
         super().__init__()
 
         self.project = Linear(
@@ -305,37 +938,30 @@ class Attention(Module):
 
         self.combine = Linear(
             in_features=hidden_size * 2,
-            out_features=hidden_size,
+            out_features=output_size,
             bias=False)
 
-    def forward(self, decoder_output, hidden_state, 
-                encoder_outputs, attn_mask=None):
+    def compute_keys(self, encoder_outputs):
+        """
+        Creates the keys of the attention. The general
+        score `h W e^T` is computed as `h (e W)^T`, so the
+        projection is applied once to the encoder outputs
+        instead of the decoder output at each step.
+        """
+        return torch.matmul(
+            encoder_outputs, self.project.weight)
+
+    def forward(self, decoder_output, encoder_outputs,
+                attn_keys, attn_mask=None):
         """
         Applies attention by creating the weighted 
         context vector. Implementation is based on 
-        `IBM/pytorch-seq2seq`.
+        `IBM/pytorch-seq2seq`. Each time step of the
+        decoder output is used as a query, so the whole
+        sequence is attended with one fused kernel, which
+        does not materialize the attention weights.
         """
-        hidden_state = self.project(hidden_state)
-        hidden_state = hidden_state.transpose(0, 1)
-        
-        encoder_outputs_t = encoder_outputs.transpose(1, 2)
-        attn_scores = torch.bmm(
-            hidden_state, encoder_outputs_t)
-
-        # applying mask on padded values of the input
         # NOTE during beam search mask might not be provided
-        if attn_mask is not None:
-            attn_scores = attn_scores.squeeze(1)
-            attn_scores.masked_fill_(
-                attn_mask, neginf(attn_scores.dtype))
-            attn_scores = attn_scores.unsqueeze(1)
-
-        attn_weights = softmax(attn_scores, dim=-1)
-        attn_applied = torch.bmm(
-            attn_weights, encoder_outputs)
-
-        stacked = torch.cat(
-            [decoder_output, attn_applied], dim=-1)
-        outputs = self.combine(stacked)
-
-        return outputs, attn_weights
+        return attend(
+            decoder_output, encoder_outputs, attn_keys,
+            self.combine.weight, attn_mask)
@@ -243,8 +243,10 @@ def compute_loss(outputs, targets, criterion, ignore_idx):
     """
     log_probs = outputs[0]
 
-    log_probs_view = log_probs.view(-1, log_probs.size(-1))
-    targets_view = targets.view(-1)
+    # the outputs might be views of the decoding buffers
+    # so reshape only copies them if it is required
+    log_probs_view = log_probs.reshape(-1, log_probs.size(-1))
+    targets_view = targets.reshape(-1)
 
     loss = criterion(log_probs_view, targets_view)
 
@@ -370,9 +372,12 @@ def main():
         attn_mask = convert_to_tensor(attn_mask)
         targets = convert_to_tensor(targets)
 
+        # the collated mask marks the tokens with ones, while
+        # the model expects the padded positions to be set
         outputs = model(
             inputs=inputs,
-            attn_mask=attn_mask.byte())
+            attn_mask=attn_mask.eq(0),
+            targets=targets)
 
         loss, accuracy = compute_loss(
             outputs=outputs,